@@ -1,11 +1,14 @@
 from __future__ import annotations
 
-import os, re, json, difflib, uuid, hmac, hashlib
+import os, re, json, sqlite3, difflib, uuid, hmac, hashlib, time, threading, bisect, functools
 import datetime as dt
-from typing import Dict, List, Optional, Tuple, Set
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Set
 
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
@@ -16,11 +19,37 @@ try:
 except Exception:
     ZoneInfo = None
 
+try:
+    from rapidfuzz import process as rf_process, fuzz as rf_fuzz  # opzionale (C++), fallback difflib
+except Exception:
+    rf_process = None
+    rf_fuzz = None
+
+try:
+    import orjson  # opzionale (C): JSON più veloce per payload webhook e sessioni
+except Exception:
+    orjson = None
+
+try:
+    import redis  # opzionale: sessioni condivise tra worker (REDIS_URL)
+except Exception:
+    redis = None
+
 # ============================================================
 # APP
 # ============================================================
 app = Flask(__name__)
 
+
+class _OrjsonProvider(DefaultJSONProvider):
+    # solo parsing (request.get_json dei webhook); le risposte restano sul provider standard
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = _OrjsonProvider(app)
+
 # ============================================================
 # ENV - GOOGLE
 # ============================================================
@@ -47,10 +76,23 @@ GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v20.0")
 # ENV - BOT SETTINGS
 # ============================================================
 SESSION_TTL_MINUTES = int(os.getenv("SESSION_TTL_MINUTES", "30"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+# Backend sessioni: memory | redis | sqlite. Vuoto = redis se REDIS_URL è valorizzato, altrimenti memory
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+# sqlite: file condiviso dai worker gunicorn della stessa macchina
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.sqlite3")
 MAX_LOOKAHEAD_DAYS = int(os.getenv("MAX_LOOKAHEAD_DAYS", "14"))
 DEFAULT_SLOT_MINUTES = int(os.getenv("DEFAULT_SLOT_MINUTES", "30"))
 BLOCK_KEYWORDS = {"chiuso", "ferie", "malattia", "off", "closed", "vacation", "sick"}
 
+# Disponibilità via freebusy.query (UNA chiamata per tutti gli operatori, solo intervalli).
+# Attenzione: freebusy ignora gli eventi "trasparenti", quindi una keyword di blocco su un
+# evento marcato "disponibile" non blocca più. Default FALSE (events.list + keyword).
+CALENDAR_USE_FREEBUSY = os.getenv("CALENDAR_USE_FREEBUSY", "false").strip().lower() in {
+    "1", "true", "yes", "y", "si", "sì"
+}
+
 # >>> IMPORTANTISSIMO: per "per sempre", tienilo a 0 (default)
 # Se >0 allora scadrebbe.
 CUSTOMER_SHOP_TTL_DAYS = int(os.getenv("CUSTOMER_SHOP_TTL_DAYS", "0"))
@@ -58,6 +100,21 @@ CUSTOMER_SHOP_TTL_DAYS = int(os.getenv("CUSTOMER_SHOP_TTL_DAYS", "0"))
 # Tab customers (default: customers)
 CUSTOMERS_TAB = os.getenv("CUSTOMERS_TAB", "customers")
 
+# Cache in memoria dei tab di configurazione (shops/services/hours/operators).
+# 0 = disattivata. customers NON passa da qui (snapshot per-request).
+TAB_CACHE_TTL_SECONDS = int(os.getenv("TAB_CACHE_TTL_SECONDS", "300"))
+CONFIG_TABS = ("shops", "services", "hours", "operators")
+# Token per /admin/invalidate_cache (vuoto = endpoint disattivato)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Opt-in: se TRUE, il batchUpdate customers di fine webhook parte in background (un solo
+# worker, ordine delle scritture preservato) e la risposta 200 a Meta non lo aspetta.
+# Le letture customers successive aspettano le scritture in coda; quelle ancora in coda
+# vanno perse se gunicorn uccide il worker (timeout/restart).
+SHEETS_ASYNC_WRITES = os.getenv("SHEETS_ASYNC_WRITES", "false").strip().lower() in {
+    "1", "true", "yes", "y", "si", "sì"
+}
+
 # Se TRUE, salviamo customer_name e last_seen_phone_number_id su customers (colonne aggiunte se mancanti)
 STORE_CUSTOMER_DEBUG_FIELDS = os.getenv("STORE_CUSTOMER_DEBUG_FIELDS", "true").strip().lower() in {
     "1", "true", "yes", "y", "si", "sì"
@@ -66,15 +123,19 @@ STORE_CUSTOMER_DEBUG_FIELDS = os.getenv("STORE_CUSTOMER_DEBUG_FIELDS", "true").s
 # ============================================================
 # GOOGLE CLIENTS
 # ============================================================
-_sheets = None
-_calendar = None
+# un client per thread: httplib2 (sotto googleapiclient) non è thread-safe
+# (gunicorn con --threads condividerebbe lo stesso client)
+_clients = threading.local()
 
 
 def _log(msg: str):
     print(msg, flush=True)
 
 
+@functools.lru_cache(maxsize=1)
 def creds():
+    # un solo Credentials per processo: JSON + import chiave RSA una volta, token condiviso
+    # dai client dei vari thread (google-auth lo rinnova da solo alla scadenza)
     if not GOOGLE_SERVICE_ACCOUNT_JSON:
         raise RuntimeError("Missing GOOGLE_SERVICE_ACCOUNT_JSON env var")
     if not GOOGLE_SHEET_ID:
@@ -88,24 +149,32 @@ def creds():
 
 
 def sheets():
-    global _sheets
-    if not _sheets:
-        _sheets = build("sheets", "v4", credentials=creds(), cache_discovery=False)
-    return _sheets
+    svc = getattr(_clients, "sheets", None)
+    if svc is None:
+        svc = _clients.sheets = build("sheets", "v4", credentials=creds(), cache_discovery=False)
+    return svc
 
 
 def calendar():
-    global _calendar
-    if not _calendar:
-        _calendar = build("calendar", "v3", credentials=creds(), cache_discovery=False)
-    return _calendar
+    svc = getattr(_clients, "calendar", None)
+    if svc is None:
+        svc = _clients.calendar = build("calendar", "v3", credentials=creds(), cache_discovery=False)
+    return svc
 
 
 # ============================================================
 # UTILS
 # ============================================================
+_RE_NON_DIGITS = re.compile(r"\D+")
+
+
 def norm_phone(p: str) -> str:
-    return re.sub(r"\D+", "", p or "")
+    if not p:
+        return ""
+    # fast path: "from" di WhatsApp e i phone già salvati sono solo cifre ASCII
+    if p.isascii() and p.isdigit():
+        return p
+    return _RE_NON_DIGITS.sub("", p)
 
 
 def now() -> dt.datetime:
@@ -131,21 +200,46 @@ def safe_lower(v: str) -> str:
     return norm_text(v).lower()
 
 
-def _iso_time(t: dt.time) -> str:
-    return t.strftime("%H:%M")
+_WD_IT = ("Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom")
 
 
-def _is_affirmative(t: str) -> bool:
-    low = safe_lower(t)
-    return low in {"ok", "va bene", "confermo", "si", "sì", "1"}
+def format_slot(d: dt.datetime) -> str:
+    # giorno in italiano via lookup, senza dipendere dal locale di %a; niente strftime
+    return f"{_WD_IT[d.weekday()]} {d.day:02d}/{d.month:02d} {d.hour:02d}:{d.minute:02d}"
 
 
-def _is_second_choice(t: str) -> bool:
-    return safe_lower(t) == "2"
+# parole chiave come frozenset (lookup O(1), niente set ricostruiti ad ogni messaggio)
+CONFIRM_WORDS = frozenset({"ok", "va bene", "confermo", "si", "sì", "1"})
+RESET_WORDS = frozenset({"reset", "annulla", "cancella"})
+CHANGE_WORDS = frozenset({"no", "cambia", "altro"})
+NEGATION_TOKENS = frozenset({"non", "senza"})
 
+GREETING_WORDS = frozenset({"ciao", "salve", "buongiorno", "buonasera", "hey"})
 
-def shop_tz(shop: Dict) -> dt.tzinfo:
-    tz_name = norm_text(shop.get("timezone")) or "UTC"
+
+def _is_greeting_only(low: str) -> bool:
+    # "ciao", "ciao!!", "buongiorno ." -> via punteggiatura/spazi finali e lookup O(1), niente regex
+    return low.rstrip("!. \t\r\n") in GREETING_WORDS
+
+
+def _choice_index(low: str, n_options: int) -> Optional[int]:
+    """
+    Opzione scelta (0-based) oppure None. `low` è il testo già normalizzato.
+    "1"/ok/confermo/... -> prima; "2" -> seconda (o la prima se ce n'è una sola).
+    """
+    # fast path numerico: niente regex per "1", "2"
+    if low.isdigit():
+        if low == "1":
+            return 0
+        if low == "2":
+            return 1 if n_options > 1 else 0
+        return None
+    return 0 if low in CONFIRM_WORDS else None
+
+
+@functools.lru_cache(maxsize=32)
+def _tz_from_name(tz_name: str) -> dt.tzinfo:
+    # pochi nomi distinti (uno per shop): anche i nomi non validi finiscono in cache -> UTC
     if ZoneInfo:
         try:
             return ZoneInfo(tz_name)
@@ -154,13 +248,19 @@ def shop_tz(shop: Dict) -> dt.tzinfo:
     return dt.timezone.utc
 
 
+def shop_tz(shop: Dict) -> dt.tzinfo:
+    return _tz_from_name(norm_text(shop.get("timezone")) or "UTC")
+
+
 def utc_now_iso() -> str:
     return now().replace(microsecond=0).isoformat()
 
 
+@functools.lru_cache(maxsize=1024)
 def parse_iso_dt(s: str) -> Optional[dt.datetime]:
+    # cache: gli updated_at dei clienti si ripetono a ogni messaggio (datetime immutabili)
     try:
-        return dt.datetime.fromisoformat(s)
+        return dt.datetime.fromisoformat(s.replace("Z", "+00:00"))
     except Exception:
         return None
 
@@ -181,104 +281,334 @@ def safe_values_get(a1: str) -> List[List[str]]:
         return []
 
 
+def safe_values_batch_get(ranges: List[str]) -> Dict[str, List[List[str]]]:
+    """Come safe_values_get, ma più range in UNA chiamata (values.batchGet)."""
+    out: Dict[str, List[List[str]]] = {a1: [] for a1 in ranges}
+    if not ranges:
+        return out
+    try:
+        res = sheets().spreadsheets().values().batchGet(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            ranges=ranges,
+            majorDimension="ROWS",
+        ).execute()
+        # valueRanges arriva nello stesso ordine dei ranges richiesti
+        for a1, vr in zip(ranges, res.get("valueRanges", []) or []):
+            out[a1] = vr.get("values", []) or []
+    except HttpError as e:
+        _log(f"[SHEETS] values.batchGet failed for {ranges}: {e}")
+    except Exception as e:
+        _log(f"[SHEETS] values.batchGet error for {ranges}: {e}")
+    return out
+
+
 # ============================================================
 # C2: SHOP=... nel primo messaggio (QR/link)
 # ============================================================
+# una sola regex (compilata al load) per estrazione e rimozione dell'hint
+_RE_SHOP_HINT = re.compile(r"\bSHOP\s*=\s*([A-Za-z0-9_\-]+)\b", re.I)
+
+
 def extract_shop_hint(text: str) -> Optional[str]:
-    m = re.search(r"\bSHOP\s*=\s*([A-Za-z0-9_\-]+)\b", text or "", flags=re.I)
+    m = _RE_SHOP_HINT.search(text or "")
     return m.group(1) if m else None
 
 
 def strip_shop_hint(text: str) -> str:
-    return re.sub(r"\bSHOP\s*=\s*[A-Za-z0-9_\-]+\b", "", text or "", flags=re.I).strip()
+    return _RE_SHOP_HINT.sub("", text or "").strip()
 
 
 # ============================================================
 # DATE / TIME PARSING
 # ============================================================
-def parse_date(text: str) -> Optional[dt.date]:
-    t = safe_lower(text)
-    today = dt.date.today()
-
-    if "oggi" in t:
-        return today
-    if "domani" in t:
-        return today + dt.timedelta(days=1)
-    if "dopodomani" in t:
-        return today + dt.timedelta(days=2)
-
-    m = re.search(r"\b(\d{1,2})[\/\-](\d{1,2})(?:[\/\-](\d{2,4}))?\b", t)
-    if m:
-        d = int(m.group(1))
-        mo = int(m.group(2))
-        y = m.group(3)
-        year = int(y) if y else today.year
-        if year < 100:
-            year += 2000
-        try:
-            return dt.date(year, mo, d)
-        except Exception:
-            return None
-    return None
+# parse_when è puro sul testo già normalizzato: cache LRU sui messaggi ripetuti
+# ("domani", "sera", "17:30"). "oggi" dipende dal giorno, quindi l'ordinal entra nella chiave.
+# Giorno, fascia, data e ora in UNA scansione con gruppi nominati (regex compilata al load);
+# le parole chiave sono sottostringhe e la più lunga vince ("dopodomani" non è "domani").
+# dmy è un lookahead (non consuma): le cifre di una data restano visibili all'alternativa
+# hhmm, come con le due regex separate ("15/13" -> ora 15:00; "12/01 alle 10" -> 12:00).
+_RE_WHEN = re.compile(
+    r"(?P<day>dopodomani|domani|oggi)"
+    r"|(?P<fascia>mattina|pomeriggio|tardo|sera)"
+    r"|(?=(?P<dmy>\b(?P<d>\d{1,2})(?P<sep>[\/\-])(?P<mo>\d{1,2})(?:[\/\-](?P<y>\d{2,4}))?\b))"
+    r"|(?P<hhmm>\b(?P<h>[01]?\d|2[0-3])[:\.]?(?P<mi>[0-5]\d)?\b)"
+)
+# "dalle 10-12" / "tra le 10-12" è una fascia oraria, non il 10 dicembre
+_RE_RANGE_WORD_BEFORE = re.compile(r"\b(?:dalle|dalla|tra|fra)(?: le)?\s*$")
+_DAY_OFFSETS = {"oggi": 0, "domani": 1, "dopodomani": 2}  # ordine = priorità
+_FASCE = {
+    "mattina": (dt.time(9, 0), dt.time(12, 0)),
+    "pomeriggio": (dt.time(14, 0), dt.time(18, 0)),
+    "tardo": (dt.time(17, 0), dt.time(21, 0)),
+    "sera": (dt.time(17, 0), dt.time(21, 0)),
+}
 
 
-def parse_time(text: str) -> Optional[dt.time]:
-    t = safe_lower(text)
-    m = re.search(r"\b([01]?\d|2[0-3])[:\.]?([0-5]\d)?\b", t)
-    if m:
-        return dt.time(int(m.group(1)), int(m.group(2) or 0))
-    return None
+def _dmy_date(d: str, mo: str, y: Optional[str], today: dt.date) -> Optional[dt.date]:
+    year = int(y) if y else today.year
+    if year < 100:
+        year += 2000
+    try:
+        return dt.date(year, int(mo), int(d))
+    except Exception:
+        return None
 
 
-def parse_fascia(text: str) -> Tuple[Optional[dt.time], Optional[dt.time]]:
-    t = safe_lower(text)
-    if "mattina" in t:
-        return dt.time(9, 0), dt.time(12, 0)
-    if "pomeriggio" in t:
-        return dt.time(14, 0), dt.time(18, 0)
-    if "tardo" in t or "sera" in t:
-        return dt.time(17, 0), dt.time(21, 0)
-    return None, None
+def parse_when(text: str, *, _norm: Optional[str] = None, today: Optional[dt.date] = None) -> Tuple[Optional[dt.date], Optional[dt.time], Optional[dt.time], Optional[dt.time]]:
+    """
+    (data, ora, fascia_da, fascia_a) dal messaggio, con UNA lookup di cache.
+    today = data locale dello shop ("oggi"/"domani" relativi al suo fuso, non a quello del server).
+    """
+    t = _norm if _norm is not None else safe_lower(text)
+    return _parse_when_cached(t, (today or dt.date.today()).toordinal())
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_when_cached(t: str, today_ordinal: int) -> Tuple[Optional[dt.date], Optional[dt.time], Optional[dt.time], Optional[dt.time]]:
+    # messaggi brevi e ripetuti ("domani", "mattina", "ok") -> quasi sempre hit;
+    # sul miss UNA finditer raccoglie giorno, fascia, data e ora.
+    # Priorità: oggi > domani > dopodomani > prima dd/mm; mattina > pomeriggio > tardo/sera; prima ora
+    days: Set[str] = set()
+    fasce: Set[str] = set()
+    dmy = None
+    tm: Optional[dt.time] = None
+    for m in _RE_WHEN.finditer(t):
+        kind = m.lastgroup
+        if kind == "day":
+            days.add(m.group("day"))
+        elif kind == "fascia":
+            fasce.add(m.group("fascia"))
+        elif kind == "dmy":
+            if dmy is None and not (m.group("sep") == "-" and _RE_RANGE_WORD_BEFORE.search(t, 0, m.start())):
+                dmy = m
+        elif tm is None:
+            tm = dt.time(int(m.group("h")), int(m.group("mi") or 0))
+
+    today = dt.date.fromordinal(today_ordinal)
+    d: Optional[dt.date] = None
+    for k, off in _DAY_OFFSETS.items():
+        if k in days:
+            d = today + dt.timedelta(days=off)
+            break
+    else:
+        if dmy is not None:
+            d = _dmy_date(dmy.group("d"), dmy.group("mo"), dmy.group("y"), today)
+
+    a, b = next((_FASCE[k] for k in _FASCE if k in fasce), (None, None))
+    return d, tm, a, b
 
 
 # ============================================================
 # FUZZY SERVICE MATCH
 # ============================================================
-def fuzzy_service(text: str, services: List[Dict]) -> Optional[Dict]:
-    q = safe_lower(text)
-    names = [safe_lower(s.get("name", "")) for s in services]
+# parole che compaiono nei nomi servizio ma anche in frasi qualsiasi: non bastano da sole
+# a scegliere un servizio (solo per l'indice token; il match sul nome intero resta)
+SERVICE_GENERIC_WORDS = frozenset({
+    "uomo", "uomini", "donna", "donne", "bambino", "bambina", "bambini", "bimbo", "bimba",
+    "ragazzo", "ragazza", "capelli", "servizio", "trattamento", "completo", "classico",
+    "corto", "corti", "lungo", "lunghi", "solo",
+})
+
+
+def fuzzy_service(text: str, services: List[Dict], *, _norm: Optional[str] = None) -> Optional[Dict]:
+    q = _norm if _norm is not None else safe_lower(text)
+    if not services:
+        return None
+    by_name, name_re, names, by_token = _service_matcher(services)
+
+    # 1) nome servizio contenuto nel testo ("taglio domani"): una sola scansione regex,
+    #    vince il nome più lungo ("taglio e barba" batte "taglio").
+    #    Ma un nome combinato scritto diversamente ("taglio e barba" per "taglio + barba")
+    #    contiene il nome corto: se un ALTRO servizio supera il cutoff fuzzy con un punteggio
+    #    più alto, vince quello (altrimenti si prenoterebbe "barba" con la durata sbagliata)
+    if name_re is not None:
+        hits = name_re.findall(q)
+        if hits:
+            hit = max(hits, key=len)
+            best = _fuzzy_best(q, names) if len(names) > 1 else None
+            if best and best[0] != hit and best[1] > _fuzzy_ratio(q, hit):
+                return by_name[best[0]]
+            return by_name[hit]
+
+    # 2) parola distintiva di UN solo servizio ("una piega" -> "piega e styling"):
+    #    lookup sull'indice per token, niente fuzzy se il risultato è univoco
+    found = {n for tok in q.split() for n in by_token.get(tok, ())}
+    if len(found) == 1:
+        return by_name[found.pop()]
+
+    # 3) fallback fuzzy sul testo intero
+    best = _fuzzy_best(q, names)
+    return by_name[best[0]] if best else None
+
+
+def _fuzzy_ratio(q: str, name: str) -> float:
+    """Similarità 0..1 (rapidfuzz se installato, altrimenti difflib)."""
+    if rf_fuzz is not None:
+        return rf_fuzz.ratio(q, name) / 100.0
+    return difflib.SequenceMatcher(None, q, name).ratio()
+
+
+def _fuzzy_best(q: str, names: List[str]) -> Optional[Tuple[str, float]]:
+    """(nome, punteggio) più simile al testo intero, solo sopra il cutoff 0.6."""
+    if rf_process is not None:
+        best = rf_process.extractOne(q, names, scorer=rf_fuzz.ratio, score_cutoff=60)
+        return (best[0], best[1] / 100.0) if best else None
     match = difflib.get_close_matches(q, names, n=1, cutoff=0.6)
-    if match:
-        target = match[0]
+    return (match[0], _fuzzy_ratio(q, match[0])) if match else None
+
+
+def _service_matcher(services: List[Dict]) -> Tuple[Dict[str, Dict], Optional["re.Pattern"], List[str], Dict[str, Tuple[str, ...]]]:
+    """
+    {nome normalizzato: servizio} + regex alternation dei nomi (più lunghi prima)
+    + lista nomi per il fuzzy + {token distintivo (>= 4 lettere): nomi che lo contengono}.
+    """
+    def build():
+        # name_norm precalcolato da load_services (fallback per dict costruiti altrove)
+        by_name: Dict[str, Dict] = {}
         for s in services:
-            if safe_lower(s.get("name", "")) == target:
-                return s
-    return None
+            name = s.get("name_norm") or safe_lower(s.get("name", ""))
+            if name:
+                by_name.setdefault(name, s)
+        names = list(by_name)
+        if not by_name:
+            return by_name, None, names, {}
+        # token corti ("e", "con", "di") e parole comuni nei messaggi ("uomo", "capelli")
+        # esclusi: non distinguono un servizio ("sono un uomo" non è "taglio uomo")
+        tok_map: Dict[str, List[str]] = {}
+        for n in names:
+            for tok in set(n.split()):
+                if len(tok) >= 4 and tok not in SERVICE_GENERIC_WORDS:
+                    tok_map.setdefault(tok, []).append(n)
+        by_token = {tok: tuple(ns) for tok, ns in tok_map.items()}
+        alt = "|".join(re.escape(n) for n in sorted(by_name, key=len, reverse=True))
+        return by_name, re.compile(rf"\b(?:{alt})\b"), names, by_token
+
+    # services di load_services è lo stesso oggetto finché la cache non cambia
+    return _derived(services, ("service_matcher", services[0].get("shop_id")), build)
 
 
 # ============================================================
 # SHEETS LOADERS
 # ============================================================
-def load_tab(tab: str) -> List[Dict]:
-    rows = safe_values_get(f"{tab}!A:Z")
+def _rows_to_dicts(rows: List[List[str]]) -> List[Dict]:
     if not rows:
         return []
     headers = rows[0]
-    out = []
-    for r in rows[1:]:
-        row = dict(zip(headers, r + [""] * (len(headers) - len(r))))
-        out.append(row)
+    nh = len(headers)
+    pad = [""] * nh
+    # Sheets restituisce solo stringhe: nessun cast per cella; padding solo per le righe corte
+    return [dict(zip(headers, r if len(r) >= nh else r + pad[len(r):])) for r in rows[1:]]
+
+
+# tab -> (timestamp, righe dict, valori grezzi Sheets): i valori servono a riconoscere
+# un refetch a contenuto invariato (vedi _tab_rows)
+_TAB_CACHE: Dict[str, Tuple[float, List[Dict], List[List[str]]]] = {}
+_TAB_CACHE_LOCK = threading.Lock()
+
+
+def _tab_cache_get(tab: str) -> Optional[List[Dict]]:
+    if TAB_CACHE_TTL_SECONDS <= 0:
+        return None
+    with _TAB_CACHE_LOCK:
+        item = _TAB_CACHE.get(tab)
+    if item and time.monotonic() - item[0] < TAB_CACHE_TTL_SECONDS:
+        return item[1]
+    return None
+
+
+def _tab_rows(tab: str, values: List[List[str]]) -> List[Dict]:
+    """
+    Righe dict del tab dai valori appena letti, e messa in cache.
+    Se il contenuto è identico all'ultimo letto (TTL scaduto ma foglio non modificato)
+    si riusa la STESSA lista: niente riconversione e i memo _derived (indici, matcher,
+    orari parsati) restano validi.
+    """
+    with _TAB_CACHE_LOCK:
+        item = _TAB_CACHE.get(tab)
+    rows = item[1] if item and item[2] == values else _rows_to_dicts(values)
+    # righe vuote = tab vuoto o errore Sheets: non le mettiamo in cache
+    if TAB_CACHE_TTL_SECONDS > 0 and rows:
+        with _TAB_CACHE_LOCK:
+            _TAB_CACHE[tab] = (time.monotonic(), rows, values)
+    return rows
+
+
+def invalidate_tab_cache(tab: Optional[str] = None):
+    with _TAB_CACHE_LOCK:
+        if tab is None:
+            _TAB_CACHE.clear()
+        else:
+            _TAB_CACHE.pop(tab, None)
+
+
+def load_tab(tab: str) -> List[Dict]:
+    rows = _tab_cache_get(tab)
+    if rows is None:
+        rows = _tab_rows(tab, safe_values_get(f"{tab}!A:Z"))
+    return rows
+
+
+def load_tabs(tabs: List[str]) -> Dict[str, List[Dict]]:
+    """Più tab con un solo round-trip Sheets (batchGet), solo per quelli non in cache."""
+    out: Dict[str, List[Dict]] = {}
+    missing = []
+    for tab in tabs:
+        rows = _tab_cache_get(tab)
+        if rows is None:
+            missing.append(tab)
+        else:
+            out[tab] = rows
+    if missing:
+        raw = safe_values_batch_get([f"{tab}!A:Z" for tab in missing])
+        for tab in missing:
+            out[tab] = _tab_rows(tab, raw[f"{tab}!A:Z"])
     return out
 
 
+# Strutture derivate (indici, righe già parsate) calcolate UNA volta per "versione"
+# delle righe in cache: valide finché load_tab restituisce lo stesso oggetto rows.
+_DERIVED: Dict[Tuple, Tuple[List[Dict], object]] = {}
+_DERIVED_LOCK = threading.Lock()
+
+
+def _derived(rows: List[Dict], key: Tuple, build):
+    with _DERIVED_LOCK:
+        item = _DERIVED.get(key)
+    if item is not None and item[0] is rows:
+        return item[1]
+    value = build()
+    with _DERIVED_LOCK:
+        _DERIVED[key] = (rows, value)
+    return value
+
+
+def _shops_index(shops: List[Dict]) -> Dict[str, Dict]:
+    by_id: Dict[str, Dict] = {}
+    by_pnid: Dict[str, List[Dict]] = {}
+    by_phone: Dict[str, List[Dict]] = {}
+    for s in shops:
+        sid = norm_text(s.get("shop_id"))
+        if sid and sid not in by_id:
+            by_id[sid] = s
+        pnid = norm_text(s.get("phone_number_id"))
+        if pnid:
+            by_pnid.setdefault(pnid, []).append(s)
+        num = norm_phone(s.get("whatsapp_number"))
+        if num:
+            by_phone.setdefault(num, []).append(s)
+    return {"by_id": by_id, "by_pnid": by_pnid, "by_phone": by_phone}
+
+
+def load_shops_index() -> Dict[str, Dict]:
+    shops = load_tab("shops")
+    return _derived(shops, ("shops_index",), lambda: _shops_index(shops))
+
+
 def get_shop_by_id(shop_id: str) -> Optional[Dict]:
     sid = norm_text(shop_id)
     if not sid:
         return None
-    for s in load_tab("shops"):
-        if norm_text(s.get("shop_id")) == sid:
-            return s
-    return None
+    return load_shops_index()["by_id"].get(sid)
 
 
 def load_shop_auto(display_phone_number: str, phone_number_id: str) -> Optional[Dict]:
@@ -288,16 +618,16 @@ def load_shop_auto(display_phone_number: str, phone_number_id: str) -> Optional[
     """
     pnid = norm_text(phone_number_id)
     disp = norm_phone(display_phone_number)
-    shops = load_tab("shops")
+    idx = load_shops_index()
 
     if pnid:
-        matches = [s for s in shops if norm_text(s.get("phone_number_id")) == pnid]
+        matches = idx["by_pnid"].get(pnid, [])
         if len(matches) == 1:
             return matches[0]
 
     # fallback (utile se hai 1 solo shop su quel display number)
     if disp:
-        matches = [s for s in shops if norm_phone(s.get("whatsapp_number")) == disp]
+        matches = idx["by_phone"].get(disp, [])
         if len(matches) == 1:
             return matches[0]
 
@@ -312,7 +642,7 @@ def _get_customers_values() -> List[List[str]]:
     return safe_values_get(f"{CUSTOMERS_TAB}!A:Z")
 
 
-def _update_customers_range(a1: str, values: List[List[str]]):
+def _values_update(a1: str, values: List[List[str]]):
     sheets().spreadsheets().values().update(
         spreadsheetId=GOOGLE_SHEET_ID,
         range=a1,
@@ -321,6 +651,72 @@ def _update_customers_range(a1: str, values: List[List[str]]):
     ).execute()
 
 
+def begin_sheets_write_buffer():
+    """
+    Da qui in poi (stessa request) gli update dei range customers vengono accumulati
+    e inviati tutti insieme da flush_sheets_writes() con UN values.batchUpdate.
+    Stesso range scritto più volte -> vince l'ultimo.
+    """
+    if has_request_context():
+        g.sheets_writes = {}
+
+
+_write_executor: Optional[ThreadPoolExecutor] = None
+_WRITE_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_write_executor() -> ThreadPoolExecutor:
+    global _write_executor
+    with _WRITE_EXECUTOR_LOCK:
+        if _write_executor is None:
+            # max_workers=1: i batchUpdate restano in ordine (stesso range -> vince l'ultimo)
+            _write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-writes")
+        return _write_executor
+
+
+def _drain_sheets_writes():
+    """Aspetta i batchUpdate in background già accodati (prima di rileggere customers)."""
+    with _WRITE_EXECUTOR_LOCK:
+        ex = _write_executor
+    if ex is not None:
+        # un solo worker FIFO: quando il no-op è eseguito, tutte le scritture precedenti sono finite
+        ex.submit(lambda: None).result()
+
+
+def _values_batch_update(buf: Dict[str, List[List[str]]]):
+    try:
+        sheets().spreadsheets().values().batchUpdate(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            body={
+                "valueInputOption": "RAW",
+                "data": [{"range": a1, "values": v} for a1, v in buf.items()],
+            },
+        ).execute()
+    except Exception as e:
+        _log(f"[SHEETS] values.batchUpdate failed for {list(buf)}: {e}")
+
+
+def flush_sheets_writes():
+    if not has_request_context():
+        return
+    buf = g.pop("sheets_writes", None)
+    if not buf:
+        return
+    if SHEETS_ASYNC_WRITES:
+        # la risposta WhatsApp è già partita: il round-trip Sheets non deve tenere occupato il webhook
+        _get_write_executor().submit(_values_batch_update, buf)
+        return
+    _values_batch_update(buf)
+
+
+def _update_customers_range(a1: str, values: List[List[str]]):
+    buf = g.get("sheets_writes") if has_request_context() else None
+    if buf is not None:
+        buf[a1] = values
+        return
+    _values_update(a1, values)
+
+
 def _append_customers_row(values: List[str]):
     sheets().spreadsheets().values().append(
         spreadsheetId=GOOGLE_SHEET_ID,
@@ -342,12 +738,89 @@ def _ensure_columns(header: List[str], needed: List[str]) -> Tuple[List[str], Di
     return header, col, changed
 
 
-def _ensure_customers_header() -> Tuple[List[str], Dict[str, int]]:
+def _index_by_phone(values: List[List[str]]) -> Dict[str, int]:
+    """{phone normalizzato: riga 1-based} (prima occorrenza)."""
+    if not values or "phone" not in values[0]:
+        return {}
+    pi = values[0].index("phone")
+    index: Dict[str, int] = {}
+    for i in range(1, len(values)):
+        row = values[i]
+        p = norm_phone(row[pi] if pi < len(row) else "")
+        if p and p not in index:
+            index[p] = i + 1
+    return index
+
+
+def _customers_snapshot() -> Tuple[List[List[str]], Dict[str, int]]:
+    """
+    values del tab customers + indice per phone.
+    Dentro una request Flask viene riusato (flask.g): lookup e upsert dello
+    stesso messaggio leggono il tab UNA volta e cercano la riga in O(1).
+    """
+    if has_request_context():
+        snap = g.get("customers_snapshot")
+        if snap is not None:
+            return snap
+    _drain_sheets_writes()
+    values = _get_customers_values()
+    snap = (values, _index_by_phone(values))
+    if has_request_context():
+        g.customers_snapshot = snap
+    return snap
+
+
+def _drop_customers_snapshot():
+    if has_request_context():
+        g.pop("customers_snapshot", None)
+
+
+def prefetch_message_context():
+    """
+    A inizio messaggio, UN solo batchGet per: tab config non in cache (shops/services/
+    hours/operators) + tab customers (snapshot per-request). Le letture successive
+    (shop, mapping cliente, servizi/orari) sono hit: 1 richiesta Sheets invece di 3.
+    """
+    missing = [tab for tab in CONFIG_TABS if _tab_cache_get(tab) is None]
+    need_customers = has_request_context() and g.get("customers_snapshot") is None
+    customers_a1 = f"{CUSTOMERS_TAB}!A:Z"
+
+    ranges = [f"{tab}!A:Z" for tab in missing]
+    if need_customers:
+        ranges.append(customers_a1)
+    if not ranges:
+        return
+
+    if need_customers:
+        _drain_sheets_writes()
+    raw = safe_values_batch_get(ranges)
+    for tab in missing:
+        _tab_rows(tab, raw[f"{tab}!A:Z"])
+    if need_customers:
+        values = raw[customers_a1]
+        g.customers_snapshot = (values, _index_by_phone(values))
+
+
+def _customer_row(customer_phone: str) -> Optional[Dict]:
+    phone = norm_phone(customer_phone)
+    if not phone:
+        return None
+    values, index = _customers_snapshot()
+    row_idx = index.get(phone)
+    if not row_idx:
+        return None
+    header = values[0]
+    r = values[row_idx - 1]
+    return dict(zip(header, r + [""] * (len(header) - len(r))))
+
+
+def _ensure_customers_header() -> Tuple[List[str], Dict[str, int], List[List[str]], Dict[str, int]]:
     """
     Garantisce che esista l'header e che contenga le colonne minime.
     Mantiene l'ordine esistente e aggiunge solo colonne mancanti.
+    Restituisce anche values + indice per phone (snapshot), così i chiamanti non rileggono il tab.
     """
-    values = _get_customers_values()
+    values, index = _customers_snapshot()
 
     # se tab vuota, crea header come nel tuo screenshot
     if not values:
@@ -356,12 +829,15 @@ def _ensure_customers_header() -> Tuple[List[str], Dict[str, int]]:
             header += ["customer_name", "last_seen_phone_number_id", "updated_at"]
         else:
             header += ["updated_at"]
-        _update_customers_range(f"{CUSTOMERS_TAB}!A1:Z1", [header])
-        values = _get_customers_values()
+        # subito (non bufferizzato): gli append successivi devono trovare l'header
+        _values_update(f"{CUSTOMERS_TAB}!A1:Z1", [header])
+        _drop_customers_snapshot()
+        values, index = _customers_snapshot()
 
     if not values:
         return (["shop_id", "phone", "last_service", "total_visits", "last_visit", "updated_at"],
-                {"shop_id": 0, "phone": 1, "last_service": 2, "total_visits": 3, "last_visit": 4, "updated_at": 5})
+                {"shop_id": 0, "phone": 1, "last_service": 2, "total_visits": 3, "last_visit": 4, "updated_at": 5},
+                [], {})
 
     header = values[0]
     needed = ["shop_id", "phone", "last_service", "total_visits", "last_visit", "updated_at"]
@@ -373,7 +849,23 @@ def _ensure_customers_header() -> Tuple[List[str], Dict[str, int]]:
         _update_customers_range(f"{CUSTOMERS_TAB}!A1:Z1", [header])
 
     col = {h: i for i, h in enumerate(header)}
-    return header, col
+    return header, col, values, index
+
+
+def _fresh_shop_id(shop_id: str, updated_at: str) -> Optional[str]:
+    """shop_id del mapping, oppure None se vuoto / scaduto (CUSTOMER_SHOP_TTL_DAYS)."""
+    sid = norm_text(shop_id)
+    if not sid:
+        return None
+
+    if CUSTOMER_SHOP_TTL_DAYS > 0:
+        ts = parse_iso_dt(updated_at or "")
+        if ts:
+            age_days = (now() - ts).total_seconds() / 86400.0
+            if age_days > CUSTOMER_SHOP_TTL_DAYS:
+                return None
+
+    return sid
 
 
 def get_customer_shop_id(customer_phone: str) -> Optional[str]:
@@ -381,41 +873,17 @@ def get_customer_shop_id(customer_phone: str) -> Optional[str]:
     Restituisce shop_id salvato per quel numero.
     Se CUSTOMER_SHOP_TTL_DAYS = 0 -> NON SCADRA' MAI (per sempre).
     """
-    phone = norm_phone(customer_phone)
-    if not phone:
+    r = _customer_row(customer_phone)
+    if not r:
         return None
-
-    rows = load_tab(CUSTOMERS_TAB)
-    for r in rows:
-        if norm_phone(r.get("phone")) != phone:
-            continue
-
-        sid = norm_text(r.get("shop_id"))
-        if not sid:
-            return None
-
-        if CUSTOMER_SHOP_TTL_DAYS > 0:
-            ts = parse_iso_dt(r.get("updated_at") or "")
-            if ts:
-                age_days = (now() - ts).total_seconds() / 86400.0
-                if age_days > CUSTOMER_SHOP_TTL_DAYS:
-                    return None
-
-        return sid
-
-    return None
+    return _fresh_shop_id(r.get("shop_id"), r.get("updated_at"))
 
 
 def get_customer_last_service(customer_phone: str) -> Optional[str]:
-    phone = norm_phone(customer_phone)
-    if not phone:
+    r = _customer_row(customer_phone)
+    if not r:
         return None
-    rows = load_tab(CUSTOMERS_TAB)
-    for r in rows:
-        if norm_phone(r.get("phone")) != phone:
-            continue
-        return norm_text(r.get("last_service"))
-    return None
+    return norm_text(r.get("last_service"))
 
 
 def upsert_customer_shop(
@@ -435,34 +903,25 @@ def upsert_customer_shop(
     if not phone or not sid:
         return
 
-    # evita update inutile se già uguale
-    current = None
-    try:
-        current = get_customer_shop_id(phone)
-    except Exception:
-        current = None
-    if current == sid and not (STORE_CUSTOMER_DEBUG_FIELDS and (customer_name or last_seen_phone_number_id)):
-        return
-
-    header, col = _ensure_customers_header()
-    values = _get_customers_values()
+    # una sola lettura del tab: header + righe + indice per phone
+    header, col, values, index = _ensure_customers_header()
     if not values:
         return
 
     updated_at = utc_now_iso()
 
-    # cerca riga cliente (unica per phone)
-    target_row = None  # 1-based
-    for i in range(1, len(values)):
-        row = values[i]
-        p = row[col["phone"]] if col["phone"] < len(row) else ""
-        if norm_phone(p) == phone:
-            target_row = i + 1
-            break
+    # riga cliente (unica per phone), 1-based
+    target_row = index.get(phone)
 
     def _pad(row: List[str]) -> List[str]:
         return row + [""] * (len(header) - len(row))
 
+    # evita update inutile se già uguale
+    if target_row and not (STORE_CUSTOMER_DEBUG_FIELDS and (customer_name or last_seen_phone_number_id)):
+        cur = _pad(values[target_row - 1])
+        if _fresh_shop_id(cur[col["shop_id"]], cur[col["updated_at"]]) == sid:
+            return
+
     if target_row:
         row = _pad(values[target_row - 1])
         row[col["phone"]] = phone
@@ -475,6 +934,7 @@ def upsert_customer_shop(
             if last_seen_phone_number_id and "last_seen_phone_number_id" in col:
                 row[col["last_seen_phone_number_id"]] = last_seen_phone_number_id
         _update_customers_range(f"{CUSTOMERS_TAB}!A{target_row}:Z{target_row}", [row])
+        values[target_row - 1] = row
     else:
         new_row = [""] * len(header)
         new_row[col["phone"]] = phone
@@ -490,6 +950,8 @@ def upsert_customer_shop(
             if last_seen_phone_number_id and "last_seen_phone_number_id" in col:
                 new_row[col["last_seen_phone_number_id"]] = last_seen_phone_number_id
         _append_customers_row(new_row)
+        values.append(new_row)
+        index[phone] = len(values)
 
 
 def update_customer_after_booking(
@@ -515,21 +977,14 @@ def update_customer_after_booking(
     if not phone or not sid:
         return
 
-    header, col = _ensure_customers_header()
-    values = _get_customers_values()
+    header, col, values, index = _ensure_customers_header()
     if not values:
         return
 
     updated_at = utc_now_iso()
     last_visit = start_dt.replace(microsecond=0).isoformat()
 
-    target_row = None
-    for i in range(1, len(values)):
-        row = values[i]
-        p = row[col["phone"]] if col["phone"] < len(row) else ""
-        if norm_phone(p) == phone:
-            target_row = i + 1
-            break
+    target_row = index.get(phone)
 
     def _pad(row: List[str]) -> List[str]:
         return row + [""] * (len(header) - len(row))
@@ -548,6 +1003,8 @@ def update_customer_after_booking(
             if last_seen_phone_number_id and "last_seen_phone_number_id" in col:
                 new_row[col["last_seen_phone_number_id"]] = last_seen_phone_number_id
         _append_customers_row(new_row)
+        values.append(new_row)
+        index[phone] = len(values)
         return
 
     row = _pad(values[target_row - 1])
@@ -579,38 +1036,61 @@ def update_customer_after_booking(
             row[col["last_seen_phone_number_id"]] = last_seen_phone_number_id
 
     _update_customers_range(f"{CUSTOMERS_TAB}!A{target_row}:Z{target_row}", [row])
+    values[target_row - 1] = row
 
 
 # ============================================================
 # LOAD SHOP DATA
 # ============================================================
-def load_services(shop_id: str) -> List[Dict]:
+# rows: righe già caricate (es. da load_tabs) per evitare un'altra lettura Sheets.
+# Il risultato per shop è memoizzato finché le righe in cache non cambiano:
+# va trattato come sola lettura.
+def load_services(shop_id: str, rows: Optional[List[Dict]] = None) -> List[Dict]:
+    rows = load_tab("services") if rows is None else rows
+    return _derived(rows, ("services", shop_id), lambda: _build_services(shop_id, rows))
+
+
+def _build_services(shop_id: str, rows: List[Dict]) -> List[Dict]:
     return [
         {
             **s,
             "duration": parse_int(s.get("duration", "30"), 30),
             "active": parse_bool(s.get("active", "TRUE")),
+            "name_norm": safe_lower(s.get("name", "")),
         }
-        for s in load_tab("services")
+        for s in rows
         if s.get("shop_id") == shop_id and parse_bool(s.get("active", "TRUE"))
     ]
 
 
-def load_hours(shop_id: str) -> Dict[int, List[Tuple[dt.time, dt.time]]]:
+def load_hours(shop_id: str, rows: Optional[List[Dict]] = None) -> Dict[int, List[Tuple[int, int]]]:
+    rows = load_tab("hours") if rows is None else rows
+    return _derived(rows, ("hours", shop_id), lambda: _build_hours(shop_id, rows))
+
+
+def _build_hours(shop_id: str, rows: List[Dict]) -> Dict[int, List[Tuple[int, int]]]:
+    """{weekday: [(inizio, fine)]} in minuti dalla mezzanotte: la ricerca slot lavora su interi."""
     out = {i: [] for i in range(7)}
-    for r in load_tab("hours"):
+    for r in rows:
         if r.get("shop_id") == shop_id:
             try:
                 wd = int(r["weekday"])
-                out[wd].append((dt.time.fromisoformat(r["start"]), dt.time.fromisoformat(r["end"])))
+                st = dt.time.fromisoformat(r["start"])
+                en = dt.time.fromisoformat(r["end"])
+                out[wd].append((st.hour * 60 + st.minute, en.hour * 60 + en.minute))
             except Exception:
                 pass
     return out
 
 
-def load_operators(shop_id: str) -> List[Dict]:
+def load_operators(shop_id: str, rows: Optional[List[Dict]] = None) -> List[Dict]:
+    rows = load_tab("operators") if rows is None else rows
+    return _derived(rows, ("operators", shop_id), lambda: _build_operators(shop_id, rows))
+
+
+def _build_operators(shop_id: str, rows: List[Dict]) -> List[Dict]:
     ops = []
-    for r in load_tab("operators"):
+    for r in rows:
         if r.get("shop_id") != shop_id:
             continue
         if not parse_bool(r.get("active", "TRUE")):
@@ -627,34 +1107,228 @@ def load_operators(shop_id: str) -> List[Dict]:
 
 
 # ============================================================
-# SESSION (memoria breve) - in-memory
+# SESSION (memoria breve) - in-memory, Redis o SQLite (SESSION_BACKEND)
 # ============================================================
-SESSIONS: Dict[str, Dict] = {}
+class SessionStore:
+    """
+    Dict in-memory con TTL + limite LRU (max_entries).
+    - scadenza lazy: su get() e ad ogni set() si eliminano le entry vecchie in testa
+    - time.monotonic() per non dipendere da salti dell'orologio di sistema
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            ts, data = item
+            if time.monotonic() - ts > self.ttl_seconds:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return data
+
+    def set(self, key: str, data: Dict):
+        with self._lock:
+            t = time.monotonic()
+            self._data[key] = (t, data)
+            self._data.move_to_end(key)
+            self._evict(t)
+
+    def pop(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _evict(self, t: float):
+        # in testa ci sono le entry usate meno di recente
+        while self._data:
+            ts, _ = next(iter(self._data.values()))
+            if len(self._data) > self.max_entries or t - ts > self.ttl_seconds:
+                self._data.popitem(last=False)
+            else:
+                break
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _session_json_default(o):
+    # datetime prima di date (è una sottoclasse)
+    if isinstance(o, dt.datetime):
+        return {"__dt__": o.isoformat()}
+    if isinstance(o, dt.date):
+        return {"__d__": o.isoformat()}
+    if isinstance(o, dt.time):
+        return {"__t__": o.isoformat()}
+    raise TypeError(f"not serializable: {type(o).__name__}")
+
+
+_SESSION_TEMPORAL_TAGS = {
+    "__dt__": dt.datetime.fromisoformat,
+    "__d__": dt.date.fromisoformat,
+    "__t__": dt.time.fromisoformat,
+}
+
+
+def _session_json_hook(d: Dict):
+    # chiamato per OGNI oggetto JSON: un solo lookup per i tag, niente catena di if
+    if len(d) == 1:
+        (tag, raw), = d.items()
+        conv = _SESSION_TEMPORAL_TAGS.get(tag)
+        if conv is not None:
+            return conv(raw)
+    return d
+
+
+def _session_dumps(data: Dict) -> str:
+    if orjson is not None:
+        # PASSTHROUGH: date/time/datetime passano da _session_json_default (tag), come con json
+        return orjson.dumps(data, default=_session_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+    return json.dumps(data, default=_session_json_default, separators=(",", ":"))
+
+
+def _session_loads(raw) -> Dict:
+    # orjson non ha object_hook: il parsing resta su json per ricostruire i tag temporali
+    return json.loads(raw, object_hook=_session_json_hook)
+
+
+class RedisSessionStore:
+    """
+    Stessa interfaccia di SessionStore, ma su Redis:
+    - sessioni condivise tra worker/istanze (l'in-memory è per-processo)
+    - scadenza gestita da Redis (EX), niente eviction lato app
+    - JSON compatto; date/time/datetime della sessione taggati e ricostruiti in lettura
+    Se Redis non risponde si logga e si prosegue senza sessione (come un TTL scaduto).
+    """
+
+    def __init__(self, url: str, ttl_seconds: float, prefix: str = "sess:"):
+        pool = redis.BlockingConnectionPool.from_url(url, max_connections=16, timeout=2)
+        self._r = redis.Redis(connection_pool=pool)
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            raw = self._r.get(self.prefix + key)
+        except Exception as e:
+            _log(f"[SESSION] redis get failed: {e}")
+            return None
+        if raw is None:
+            return None
+        return _session_loads(raw)
+
+    def set(self, key: str, data: Dict):
+        payload = _session_dumps(data)
+        try:
+            self._r.set(self.prefix + key, payload, ex=self.ttl_seconds)
+        except Exception as e:
+            _log(f"[SESSION] redis set failed: {e}")
+
+    def pop(self, key: str):
+        try:
+            self._r.delete(self.prefix + key)
+        except Exception as e:
+            _log(f"[SESSION] redis delete failed: {e}")
+
+
+class SQLiteSessionStore:
+    """
+    Stessa interfaccia di SessionStore, su un file SQLite (WAL):
+    sessioni condivise tra i worker della stessa macchina, senza servizi esterni.
+    Scadenza: expires_at (epoch) controllato in lettura + pulizia ad ogni set().
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()  # una connessione per thread
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)  # autocommit
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            row = self._conn().execute(
+                "SELECT data FROM sessions WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        except Exception as e:
+            _log(f"[SESSION] sqlite get failed: {e}")
+            return None
+        return _session_loads(row[0]) if row else None
+
+    def set(self, key: str, data: Dict):
+        payload = _session_dumps(data)
+        t = time.time()
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO sessions (key, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (key, payload, t + self.ttl_seconds),
+            )
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (t,))
+        except Exception as e:
+            _log(f"[SESSION] sqlite set failed: {e}")
+
+    def pop(self, key: str):
+        try:
+            self._conn().execute("DELETE FROM sessions WHERE key = ?", (key,))
+        except Exception as e:
+            _log(f"[SESSION] sqlite delete failed: {e}")
+
+
+def _make_session_store():
+    ttl = SESSION_TTL_MINUTES * 60
+    backend = SESSION_BACKEND or ("redis" if REDIS_URL else "memory")
+    if backend == "redis":
+        if redis is not None and REDIS_URL:
+            return RedisSessionStore(REDIS_URL, ttl)
+        _log("[SESSION] backend redis senza REDIS_URL o pacchetto redis: sessioni in memoria")
+    elif backend == "sqlite":
+        return SQLiteSessionStore(SESSION_SQLITE_PATH, ttl)
+    elif backend != "memory":
+        _log(f"[SESSION] SESSION_BACKEND sconosciuto: {backend!r}, sessioni in memoria")
+    return SessionStore(ttl, SESSION_MAX_ENTRIES)
+
+
+SESSIONS = _make_session_store()
 
 
 def get_session(key: str) -> Dict:
     s = SESSIONS.get(key)
-    if not s:
-        return {}
-    if (now() - s["ts"]).total_seconds() / 60 > SESSION_TTL_MINUTES:
-        del SESSIONS[key]
-        return {}
-    return dict(s)
+    return dict(s) if s else {}
 
 
 def save_session(key: str, data: Dict):
-    SESSIONS[key] = {"ts": now(), **data}
+    SESSIONS.set(key, dict(data))
 
 
 def clear_session(key: str):
-    if key in SESSIONS:
-        del SESSIONS[key]
+    SESSIONS.pop(key)
 
 
 # ============================================================
 # DEDUP message ids (anti doppia risposta)
 # ============================================================
 PROCESSED_MSG_IDS: Dict[str, dt.datetime] = {}
+# gunicorn gthread: check-and-set atomico, altrimenti due retry di Meta in parallelo
+# passerebbero entrambi (doppia risposta)
+_PROCESSED_LOCK = threading.Lock()
 
 
 def _gc_processed(ttl_minutes: int = 60):
@@ -665,13 +1339,14 @@ def _gc_processed(ttl_minutes: int = 60):
 
 
 def seen_message(message_id: str) -> bool:
-    _gc_processed()
-    if not message_id:
+    with _PROCESSED_LOCK:
+        _gc_processed()
+        if not message_id:
+            return False
+        if message_id in PROCESSED_MSG_IDS:
+            return True
+        PROCESSED_MSG_IDS[message_id] = now()
         return False
-    if message_id in PROCESSED_MSG_IDS:
-        return True
-    PROCESSED_MSG_IDS[message_id] = now()
-    return False
 
 
 # ============================================================
@@ -690,22 +1365,59 @@ def _operator_tokens(op: Dict) -> List[str]:
     return list({t for t in toks if t})
 
 
-def parse_operator_prefs(text: str, operators: List[Dict]) -> Tuple[Optional[str], Set[str]]:
-    t = " " + safe_lower(text) + " "
-    preferred: Optional[str] = None
-    excluded: Set[str] = set()
-    neg_markers = [" non ", " senza ", " no ", " evita ", " non voglio "]
+# marker delle preferenze operatore come parola intera; "voglio" preceduto da "non" è negativo
+_RE_OPERATOR_MARKERS = re.compile(r" (non|senza|no|evita|con|da|voglio|preferisco)(?= )")
+_NEG_MARKERS = frozenset({"non", "senza", "no", "evita"})
+_POS_MARKERS = frozenset({"con", "da", "voglio", "preferisco"})
+
 
+def _operator_prefs_matcher(operators: List[Dict]) -> List[Tuple[str, List[str]]]:
+    """
+    [(token, [operator_id, ...])] per la lista operatori.
+    Stesse regole dei marker testuali: "non/senza/no/evita/non voglio <nome>" seguito da
+    spazio/./, esclude; "con/da/voglio/preferisco <nome>" seguito da spazio, preferisce.
+    """
+    by_tok: Dict[str, List[str]] = {}
     for op in operators:
         op_id = op.get("operator_id")
         if not op_id:
             continue
         for tok in _operator_tokens(op):
-            for nm in neg_markers:
-                if nm + tok + " " in t or nm + tok + "." in t or nm + tok + "," in t:
-                    excluded.add(op_id)
-            if f" con {tok} " in t or f" da {tok} " in t or f" voglio {tok} " in t or f" preferisco {tok} " in t:
-                preferred = op_id
+            by_tok.setdefault(tok, []).append(op_id)
+    return list(by_tok.items())
+
+
+def parse_operator_prefs(text: str, operators: List[Dict], *, _norm: Optional[str] = None) -> Tuple[Optional[str], Set[str]]:
+    t = " " + (_norm if _norm is not None else safe_lower(text)) + " "
+    preferred: Optional[str] = None
+    excluded: Set[str] = set()
+
+    shop_id = operators[0].get("shop_id") if operators else None
+    toks = _derived(operators, ("operator_prefs", shop_id), lambda: _operator_prefs_matcher(operators))
+    if not toks:
+        return None, excluded
+
+    # UNA scansione per i marker; dopo ogni marker si provano TUTTI i nomi (anche quelli
+    # che sono prefisso di un altro: "marco" e "marco rossi" valgono entrambi, come prima)
+    wanted = set()
+    for m in _RE_OPERATOR_MARKERS.finditer(t):
+        word = m.group(1)
+        start = m.end() + 1
+        neg = word in _NEG_MARKERS or (word == "voglio" and t.endswith(" non", 0, m.start()))
+        pos = word in _POS_MARKERS
+        for tok, op_ids in toks:
+            if not t.startswith(tok, start):
+                continue
+            nxt = t[start + len(tok):start + len(tok) + 1]
+            # "non voglio marco" vale sia come esclusione che come " voglio marco "
+            if neg and nxt in (" ", ".", ","):
+                excluded.update(op_ids)
+            if pos and nxt == " ":
+                wanted.update(op_ids)
+    # come prima: vince l'ultimo operatore (in ordine di lista) citato come preferito
+    for op in operators:
+        if op.get("operator_id") in wanted:
+            preferred = op["operator_id"]
 
     if preferred and preferred in excluded:
         preferred = None
@@ -715,29 +1427,115 @@ def parse_operator_prefs(text: str, operators: List[Dict]) -> Tuple[Optional[str
 # ============================================================
 # CALENDAR HELPERS
 # ============================================================
+# una sola ricerca regex (sottostringa, come prima) invece di un `in` per keyword
+_RE_BLOCK_KEYWORDS = re.compile("|".join(re.escape(k) for k in sorted(BLOCK_KEYWORDS, key=len, reverse=True)))
+
+
 def _has_block_keyword(summary: str) -> bool:
-    s = safe_lower(summary)
-    return any(k in s for k in BLOCK_KEYWORDS)
+    return _RE_BLOCK_KEYWORDS.search(safe_lower(summary)) is not None
 
 
-def slot_is_free(calendar_id: str, start: dt.datetime, end: dt.datetime) -> bool:
-    evs = calendar().events().list(
-        calendarId=calendar_id,
-        timeMin=start.isoformat(),
-        timeMax=end.isoformat(),
-        singleEvents=True,
-        orderBy="startTime",
-        maxResults=50
-    ).execute().get("items", [])
+def _event_blocks(ev: Dict) -> bool:
+    if _has_block_keyword(ev.get("summary", "")):
+        return True
+    return ev.get("transparency", "") != "transparent"
+
+
+def _event_bound(b: Dict, tz: dt.tzinfo) -> Optional[dt.datetime]:
+    # dateTime per eventi normali, date per eventi "tutto il giorno"
+    if b.get("dateTime"):
+        return parse_iso_dt(b["dateTime"])
+    if b.get("date"):
+        try:
+            return dt.datetime.combine(dt.date.fromisoformat(b["date"]), dt.time(0, 0), tzinfo=tz)
+        except Exception:
+            return None
+    return None
 
+
+def load_busy_intervals(calendar_id: str, start: dt.datetime, end: dt.datetime) -> List[Tuple[dt.datetime, dt.datetime]]:
+    """
+    Intervalli occupati (start, end) in [start, end), ordinati per inizio.
+    Evento bloccante = _event_blocks (keyword di blocco / eventi non trasparenti);
+    UNA sola chiamata Calendar (paginata) per tutta la finestra.
+    """
+    evs: List[Dict] = []
+    page_token = None
+    while True:
+        res = calendar().events().list(
+            calendarId=calendar_id,
+            timeMin=start.isoformat(),
+            timeMax=end.isoformat(),
+            singleEvents=True,
+            orderBy="startTime",
+            maxResults=250,
+            pageToken=page_token,
+            fields="nextPageToken,items(summary,transparency,start,end)",
+        ).execute()
+        evs.extend(res.get("items", []) or [])
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            break
+
+    out: List[Tuple[dt.datetime, dt.datetime]] = []
     for ev in evs:
-        summary = ev.get("summary", "")
-        transparency = ev.get("transparency", "")
-        if _has_block_keyword(summary):
-            return False
-        if transparency != "transparent":
-            return False
-    return True
+        if not _event_blocks(ev):
+            continue
+        s = _event_bound(ev.get("start") or {}, start.tzinfo or dt.timezone.utc)
+        e = _event_bound(ev.get("end") or {}, start.tzinfo or dt.timezone.utc)
+        if s and e:
+            out.append((s, e))
+    out.sort(key=lambda x: x[0])
+    return out
+
+
+def load_busy_intervals_many(calendar_ids: List[str], start: dt.datetime, end: dt.datetime) -> Dict[str, List[Tuple[dt.datetime, dt.datetime]]]:
+    """
+    Come load_busy_intervals ma per più calendari con UNA freebusy.query
+    (risposta = solo intervalli busy). I calendari in errore ripiegano su events.list.
+    """
+    res = calendar().freebusy().query(
+        body={
+            "timeMin": start.isoformat(),
+            "timeMax": end.isoformat(),
+            "items": [{"id": cid} for cid in calendar_ids],
+        },
+    ).execute()
+    cals = res.get("calendars", {}) or {}
+
+    out: Dict[str, List[Tuple[dt.datetime, dt.datetime]]] = {}
+    for cid in calendar_ids:
+        cal = cals.get(cid) or {}
+        if cal.get("errors") or "busy" not in cal:
+            _log(f"[CAL] freebusy failed for {cid}: {cal.get('errors')}")
+            out[cid] = load_busy_intervals(cid, start, end)
+            continue
+        iv = []
+        for b in cal["busy"]:
+            s = parse_iso_dt(b.get("start") or "")
+            e = parse_iso_dt(b.get("end") or "")
+            if s and e:
+                iv.append((s, e))
+        iv.sort(key=lambda x: x[0])
+        out[cid] = iv
+    return out
+
+
+def busy_index(intervals: List[Tuple[dt.datetime, dt.datetime]]) -> Tuple[List[dt.datetime], List[dt.datetime]]:
+    """(starts, max_end_prefix): starts ordinati + massimo cumulativo delle fini."""
+    starts: List[dt.datetime] = []
+    max_ends: List[dt.datetime] = []
+    for s, e in intervals:
+        starts.append(s)
+        max_ends.append(e if not max_ends or e > max_ends[-1] else max_ends[-1])
+    return starts, max_ends
+
+
+def overlaps_busy(index: Tuple[List[dt.datetime], List[dt.datetime]], start: dt.datetime, end: dt.datetime) -> bool:
+    # eventi con inizio < end: [0, i); c'è overlap se almeno uno finisce dopo start
+    starts, max_ends = index
+    i = bisect.bisect_left(starts, end)
+    return i > 0 and max_ends[i - 1] > start
 
 
 def find_event_by_booking_key(calendar_id: str, start: dt.datetime, end: dt.datetime, booking_key: str) -> Optional[Dict]:
@@ -749,7 +1547,8 @@ def find_event_by_booking_key(calendar_id: str, start: dt.datetime, end: dt.date
         timeMax=buf_end,
         singleEvents=True,
         orderBy="startTime",
-        maxResults=50
+        maxResults=50,
+        fields="items(id,extendedProperties/private/booking_key)",
     ).execute().get("items", [])
     for ev in evs:
         ep = (ev.get("extendedProperties") or {}).get("private") or {}
@@ -771,10 +1570,6 @@ def create_booking_event(
     booking_key: str,
     notes: str = ""
 ) -> str:
-    existing = find_event_by_booking_key(calendar_id, start, end, booking_key)
-    if existing:
-        return existing.get("id", "")
-
     summary = f"{service_name} – {customer_name}".strip(" –")
 
     description_lines = [
@@ -809,7 +1604,23 @@ def create_booking_event(
         }
     }
 
-    ev = calendar().events().insert(calendarId=calendar_id, body=body).execute()
+    # id evento = booking_key (uuid5 hex: caratteri validi base32hex) -> idempotenza con UNA chiamata:
+    # se l'evento esiste già Calendar risponde 409 e non serve il list preventivo
+    body["id"] = booking_key
+    try:
+        ev = calendar().events().insert(calendarId=calendar_id, body=body, fields="id").execute()
+        return ev.get("id", "")
+    except HttpError as e:
+        if getattr(e.resp, "status", None) != 409:
+            raise
+
+    existing = find_event_by_booking_key(calendar_id, start, end, booking_key)
+    if existing:
+        return existing.get("id", "")
+
+    # id occupato da un evento cancellato: inserisci con id generato da Calendar
+    body.pop("id", None)
+    ev = calendar().events().insert(calendarId=calendar_id, body=body, fields="id").execute()
     return ev.get("id", "")
 
 
@@ -817,7 +1628,7 @@ def create_booking_event(
 # SEARCH
 # ============================================================
 def find_best_slots(
-    hours: Dict[int, List[Tuple[dt.time, dt.time]]],
+    hours: Dict[int, List[Tuple[int, int]]],
     operators: List[Dict],
     base_date: dt.date,
     dur_min: int,
@@ -829,6 +1640,7 @@ def find_best_slots(
     excluded_operator_ids: Set[str],
     tz: dt.tzinfo,
     limit: int = 2,
+    now_local: Optional[dt.datetime] = None,
 ) -> List[Tuple[dt.datetime, Dict]]:
     ops_by_id = {op.get("operator_id"): op for op in operators if op.get("operator_id")}
 
@@ -845,48 +1657,95 @@ def find_best_slots(
             ordered.append(op)
         return ordered
 
-    def candidate_slots_for_day(day: dt.date) -> List[dt.datetime]:
-        slots: List[dt.datetime] = []
-        for st, en in hours.get(day.weekday(), []):
-            sst = st
-            een = en
-
-            if after and sst < after:
-                sst = after
-            if before and een > before:
-                een = before
-            if sst >= een:
-                continue
+    # invarianti calcolati una volta sola (fuori dai loop giorni/slot)
+    dur_td = dt.timedelta(minutes=dur_min)
+    now_local = now_local or now().astimezone(tz)
+    today = now_local.date()
+
+    def _m(t: dt.time) -> int:
+        return t.hour * 60 + t.minute
+
+    # fasce e orario preferito in minuti dall'inizio del giorno (interi, niente timedelta nel loop)
+    after_m = _m(after) if after else None
+    before_m = _m(before) if before else None
+    pref_m = _m(preferred_time) if preferred_time else None
+    step_m = max(1, slot_minutes)  # slot_minutes=0 dal foglio non deve bloccare il loop
+
+    # oggi: primo minuto utile arrotondato per eccesso (secondi inclusi), così gli slot
+    # già passati non vengono nemmeno generati
+    now_m = now_local.hour * 60 + now_local.minute + (1 if (now_local.second or now_local.microsecond) else 0)
+
+    def _fits(intervals: List[Tuple[int, int]], start_m: int) -> bool:
+        # O(fasce): [start_m, start_m + durata] dentro una fascia (ristretta da after/before)
+        end_m = start_m + dur_min
+        for s_m, e_m in intervals:
+            if after_m is not None and s_m < after_m:
+                s_m = after_m
+            if before_m is not None and e_m > before_m:
+                e_m = before_m
+            if s_m <= start_m and end_m <= e_m:
+                return True
+        return False
 
-            if preferred_time:
-                cand = dt.datetime.combine(day, preferred_time, tzinfo=tz)
-                if cand.time() >= sst and (cand + dt.timedelta(minutes=dur_min)).time() <= een:
-                    return [cand]
-                return []
+    def candidate_slots_for_day(day: dt.date) -> Iterator[dt.datetime]:
+        # generatore: gli slot vengono costruiti solo finché servono (stop a `limit`);
+        # il datetime si crea solo per lo slot restituito
+        y, mo, dd = day.year, day.month, day.day
+        min_m = now_m if day == today else 0
+        intervals = hours.get(day.weekday(), [])
+
+        if pref_m is not None:
+            # orario preciso: basta verificare che cada in una delle fasce del giorno
+            if pref_m >= min_m and _fits(intervals, pref_m):
+                yield dt.datetime(y, mo, dd, pref_m // 60, pref_m % 60, tzinfo=tz)
+            return
+
+        for s_m, e_m in intervals:
+            if after_m is not None and s_m < after_m:
+                s_m = after_m
+            if before_m is not None and e_m > before_m:
+                e_m = before_m
+            if s_m >= e_m:
+                continue
 
-            cur = dt.datetime.combine(day, sst, tzinfo=tz)
-            limit_dt = dt.datetime.combine(day, een, tzinfo=tz)
-            while cur + dt.timedelta(minutes=dur_min) <= limit_dt:
-                slots.append(cur)
-                cur += dt.timedelta(minutes=slot_minutes)
-        return slots
+            if s_m < min_m:
+                # primo slot della griglia (ancorata a s_m) >= min_m, in forma chiusa
+                s_m += -(-(min_m - s_m) // step_m) * step_m
+            for m in range(s_m, e_m - dur_min + 1, step_m):
+                yield dt.datetime(y, mo, dd, m // 60, m % 60, tzinfo=tz)
 
     ordered_ops = op_order()
     results: List[Tuple[dt.datetime, Dict]] = []
 
+    # busy per calendar_id: UNA chiamata Calendar per operatore su tutta la finestra
+    # [base_date, base_date + MAX_LOOKAHEAD_DAYS), fatta solo se l'operatore serve;
+    # poi il test di overlap sugli slot è in memoria (bisect)
+    window_start = dt.datetime.combine(max(base_date, today), dt.time(0, 0), tzinfo=tz)
+    window_end = dt.datetime.combine(base_date + dt.timedelta(days=MAX_LOOKAHEAD_DAYS), dt.time(0, 0), tzinfo=tz)
+    busy_cache: Dict[str, Tuple[List[dt.datetime], List[dt.datetime]]] = {}
+
+    def is_free(cal_id: str, start: dt.datetime, end: dt.datetime) -> bool:
+        if cal_id not in busy_cache:
+            if CALENDAR_USE_FREEBUSY:
+                # freebusy: tutti i calendari degli operatori in una chiamata
+                ids = list(dict.fromkeys(op["calendar_id"] for op in ordered_ops if op.get("calendar_id")))
+                for cid, iv in load_busy_intervals_many(ids, window_start, window_end).items():
+                    busy_cache[cid] = busy_index(iv)
+            else:
+                busy_cache[cal_id] = busy_index(load_busy_intervals(cal_id, window_start, window_end))
+        return not overlaps_busy(busy_cache[cal_id], start, end)
+
     for day_offset in range(MAX_LOOKAHEAD_DAYS):
         day = base_date + dt.timedelta(days=day_offset)
-        day_slots = candidate_slots_for_day(day)
-        if not day_slots:
+        if day < today:
             continue
-
-        for slot_dt in day_slots:
-            end_dt = slot_dt + dt.timedelta(minutes=dur_min)
+        for slot_dt in candidate_slots_for_day(day):
+            end_dt = slot_dt + dur_td
             for op in ordered_ops:
                 cal_id = op.get("calendar_id")
                 if not cal_id:
                     continue
-                if slot_is_free(cal_id, slot_dt, end_dt):
+                if is_free(cal_id, slot_dt, end_dt):
                     results.append((slot_dt, op))
                     if len(results) >= limit:
                         return results
@@ -904,22 +1763,16 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
     key = f"{shop_id}:{norm_phone(customer_phone)}"
     sess = get_session(key)
 
-    services = load_services(shop_id)
-    hours = load_hours(shop_id)
-    operators = load_operators(shop_id)
-
-    slot_minutes = parse_int(shop.get("slot_minutes", ""), DEFAULT_SLOT_MINUTES)
+    # testo normalizzato una sola volta e passato ai parser (_norm)
     low = safe_lower(text)
 
-    if customer_name and "customer_name" not in sess:
-        sess["customer_name"] = customer_name
-
-    if low in {"reset", "annulla", "cancella"}:
+    # fast path: reset / saluto prima di caricare services/hours/operators da Sheets
+    if low in RESET_WORDS:
         clear_session(key)
         return "Ok 👍 Ho azzerato la richiesta. Dimmi che servizio ti serve."
 
     # Saluto: se abbiamo info last_service, la citiamo (bella UX)
-    if low in {"ciao", "salve", "buongiorno", "buonasera"} and not sess:
+    if _is_greeting_only(low) and not sess:
         last_srv = None
         try:
             last_srv = get_customer_last_service(customer_phone)
@@ -938,23 +1791,16 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
             "Dimmi pure che servizio ti serve 😊"
         )
 
-    if operators:
-        pref, excl = parse_operator_prefs(text, operators)
-        if pref:
-            sess["preferred_operator_id"] = pref
-        if excl:
-            cur_excl = set(sess.get("excluded_operator_ids") or [])
-            cur_excl |= set(excl)
-            sess["excluded_operator_ids"] = list(cur_excl)
+    if customer_name and "customer_name" not in sess:
+        sess["customer_name"] = customer_name
 
+    # fast path: scelta di uno slot già proposto ("1", "ok", ...) -> tutto è in sessione,
+    # niente services/hours/operators da Sheets
     if sess.get("state") == "await_choice" and sess.get("options"):
-        if _is_affirmative(text) or _is_second_choice(text):
-            idx = 0 if _is_affirmative(text) else 1
-            if idx >= len(sess["options"]):
-                idx = 0
-
+        idx = _choice_index(low, len(sess["options"]))
+        if idx is not None:
             opt = sess["options"][idx]
-            start = dt.datetime.fromisoformat(opt["slot"])
+            start = opt["slot"]
             op = opt["operator"]
             service = sess["service"]
             dur = int(service.get("duration", 30))
@@ -998,12 +1844,29 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
                 "Perfetto! ✅ Appuntamento confermato.\n\n"
                 f"🔧 *{service['name']}*\n"
                 f"👤 Con: *{operator_label(op)}*\n"
-                f"🕒 {start.strftime('%a %d/%m %H:%M')}\n"
+                f"🕒 {format_slot(start)}\n"
                 f"🔖 Booking ID: {booking_id}\n\n"
                 "A presto 😊"
             )
 
-        if ("non " in low) or ("senza " in low) or low in {"no", "cambia", "altro"}:
+    tabs = load_tabs(["services", "hours", "operators"])
+    services = load_services(shop_id, tabs["services"])
+    hours = load_hours(shop_id, tabs["hours"])
+    operators = load_operators(shop_id, tabs["operators"])
+
+    slot_minutes = parse_int(shop.get("slot_minutes", ""), DEFAULT_SLOT_MINUTES)
+
+    if operators:
+        pref, excl = parse_operator_prefs(text, operators, _norm=low)
+        if pref:
+            sess["preferred_operator_id"] = pref
+        if excl:
+            cur_excl = set(sess.get("excluded_operator_ids") or [])
+            cur_excl |= set(excl)
+            sess["excluded_operator_ids"] = list(cur_excl)
+
+    if sess.get("state") == "await_choice" and sess.get("options"):
+        if low in CHANGE_WORDS or not NEGATION_TOKENS.isdisjoint(low.split()):
             first_op = sess["options"][0]["operator"]
             oid = first_op.get("operator_id")
             if oid:
@@ -1013,38 +1876,42 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
 
             sess["state"] = "searching"
             sess.pop("options", None)
-            save_session(key, sess)
 
     if "service" not in sess:
-        service = fuzzy_service(text, services)
+        service = fuzzy_service(text, services, _norm=low)
         if service:
             sess["service"] = service
-            save_session(key, sess)
         else:
             lst = "\n".join(f"• {s['name']}" for s in services) if services else "• (nessun servizio configurato)"
             return "Dimmi solo che servizio ti serve:\n" + lst
 
-    d = parse_date(text)
-    t = parse_time(text)
-    a, b = parse_fascia(text)
+    # ora locale dello shop UNA volta per messaggio (parser date + ricerca slot)
+    tz = shop_tz(shop)
+    now_local = now().astimezone(tz)
+
+    d, t, a, b = parse_when(text, _norm=low, today=now_local.date())
 
+    # date/time nativi in sessione: memory li tiene così, redis/sqlite li serializzano con tag JSON
     if d:
-        sess["date"] = d.isoformat()
+        sess["date"] = d
     if t:
-        sess["time"] = _iso_time(t)
+        sess["time"] = t
     if a and b:
-        sess["after"] = _iso_time(a)
-        sess["before"] = _iso_time(b)
-
-    save_session(key, sess)
+        sess["after"] = a
+        sess["before"] = b
 
+    # una sola save_session per messaggio: subito prima di ogni risposta
+    # (con Redis ogni save è un round-trip)
     if "date" not in sess:
+        save_session(key, sess)
         return "Perfetto 👍 Quando preferisci? (es. *domani* oppure *12/01*)"
 
     if "time" not in sess and "after" not in sess:
+        save_session(key, sess)
         return "Preferisci *mattina*, *pomeriggio* o *sera*? 😊"
 
     if not operators:
+        save_session(key, sess)
         return (
             "Mi manca la configurazione degli operatori 😕\n"
             "Nel foglio Google, tab *operators*, aggiungi almeno un operatore con calendar_id."
@@ -1052,17 +1919,15 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
 
     service = sess["service"]
     dur = int(service.get("duration", 30))
-    base = dt.date.fromisoformat(sess["date"])
+    base = sess["date"]
 
-    preferred_time = dt.time.fromisoformat(sess["time"]) if sess.get("time") else None
-    after = dt.time.fromisoformat(sess["after"]) if sess.get("after") else None
-    before = dt.time.fromisoformat(sess["before"]) if sess.get("before") else None
+    preferred_time = sess.get("time")
+    after = sess.get("after")
+    before = sess.get("before")
 
     preferred_operator_id = sess.get("preferred_operator_id")
     excluded_operator_ids = set(sess.get("excluded_operator_ids") or [])
 
-    tz = shop_tz(shop)
-
     options = find_best_slots(
         hours=hours,
         operators=operators,
@@ -1075,34 +1940,37 @@ def handle(shop: Dict, customer_phone: str, text: str, customer_name: Optional[s
         preferred_operator_id=preferred_operator_id,
         excluded_operator_ids=excluded_operator_ids,
         tz=tz,
-        limit=2
+        limit=2,
+        now_local=now_local,
     )
 
     if not options:
+        save_session(key, sess)
         return (
             "Al momento non vedo disponibilità nei prossimi giorni 😕\n"
             "Vuoi provare un altro giorno o un’altra fascia?"
         )
 
-    packed = []
-    for slot_dt, op in options:
-        packed.append({"slot": slot_dt.isoformat(), "operator": op})
-
-    sess["options"] = packed
+    # datetime nativi in sessione: niente isoformat/fromisoformat nel codice del bot
+    sess["options"] = [{"slot": slot_dt, "operator": op} for slot_dt, op in options]
     sess["state"] = "await_choice"
     sess["booking_id"] = sess.get("booking_id") or uuid.uuid4().hex[:10]
     save_session(key, sess)
 
-    msg = "Ti propongo questi orari 👇\n\n"
-    slot1, op1 = options[0]
-    msg += f"1) 🕒 {slot1.strftime('%a %d/%m %H:%M')} — con *{operator_label(op1)}*\n"
-    if len(options) > 1:
-        slot2, op2 = options[1]
-        msg += f"2) 🕒 {slot2.strftime('%a %d/%m %H:%M')} — con *{operator_label(op2)}*\n"
+    return render_options(options)
+
 
-    msg += "\nRispondi *1* o *2* (oppure *OK* per confermare la 1).\n"
-    msg += "Se vuoi un operatore specifico scrivi: *con Marco* oppure *non Marco* 😊"
-    return msg
+def render_options(options: List[Tuple[dt.datetime, Dict]]) -> str:
+    lines = "\n".join(
+        f"{i}) 🕒 {format_slot(slot_dt)} — con *{operator_label(op)}*"
+        for i, (slot_dt, op) in enumerate(options, 1)
+    )
+    return (
+        "Ti propongo questi orari 👇\n\n"
+        f"{lines}\n\n"
+        "Rispondi *1* o *2* (oppure *OK* per confermare la 1).\n"
+        "Se vuoi un operatore specifico scrivi: *con Marco* oppure *non Marco* 😊"
+    )
 
 
 # ============================================================
@@ -1128,6 +1996,25 @@ def verify_meta_signature(req) -> bool:
 # ============================================================
 # WHATSAPP SEND
 # ============================================================
+_wa_http = None
+# gunicorn gthread: senza lock due prime risposte in parallelo creerebbero due Session/pool
+_WA_HTTP_LOCK = threading.Lock()
+
+
+def wa_http() -> requests.Session:
+    # Session riusata: keep-alive + pool di connessioni verso graph.facebook.com
+    # (niente handshake TLS ad ogni risposta)
+    global _wa_http
+    if _wa_http is None:
+        with _WA_HTTP_LOCK:
+            if _wa_http is None:
+                sess = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+                sess.mount("https://", adapter)
+                _wa_http = sess
+    return _wa_http
+
+
 def wa_send_text(to_phone: str, text: str, phone_number_id: Optional[str] = None):
     pid = (phone_number_id or "").strip() or META_PHONE_NUMBER_ID
     if not pid:
@@ -1146,7 +2033,7 @@ def wa_send_text(to_phone: str, text: str, phone_number_id: Optional[str] = None
         "type": "text",
         "text": {"body": text},
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=15)
+    r = wa_http().post(url, headers=headers, json=payload, timeout=15)
     if r.status_code >= 300:
         raise RuntimeError(f"WhatsApp send failed: {r.status_code} {r.text}")
 
@@ -1158,6 +2045,26 @@ def _is_meta_sample_payload(display_phone: str, phone_number_id: str) -> bool:
 # ============================================================
 # ROUTES
 # ============================================================
+def warmup():
+    """
+    Da chiamare all'avvio di ogni worker (gunicorn.conf.py): tab config in cache e
+    regex dei servizi compilate prima del primo messaggio, che altrimenti paga tutto.
+    """
+    try:
+        tabs = load_tabs(list(CONFIG_TABS))
+        shops = tabs["shops"]
+        shop_ids = list(_derived(shops, ("shops_index",), lambda: _shops_index(shops))["by_id"])
+        for shop_id in shop_ids:
+            services = load_services(shop_id, tabs["services"])
+            if services:
+                _service_matcher(services)
+            load_hours(shop_id, tabs["hours"])
+            load_operators(shop_id, tabs["operators"])
+        _log(f"[WARMUP] ok: {len(shop_ids)} shops")
+    except Exception as e:
+        _log(f"[WARMUP] failed: {e}")
+
+
 @app.route("/", methods=["GET"])
 def home():
     return "OK - WhatsApp Bot online ✅", 200
@@ -1185,6 +2092,8 @@ def webhook():
 
     data = request.get_json(silent=True) or {}
 
+    # scritture customers della request -> un solo batchUpdate a fine webhook
+    begin_sheets_write_buffer()
     try:
         entries = data.get("entry", []) or []
         for entry in entries:
@@ -1227,6 +2136,11 @@ def webhook():
 
                     text = ((m.get("text") or {}).get("body")) or ""
 
+                    try:
+                        prefetch_message_context()
+                    except Exception as e:
+                        _log(f"[PREFETCH] failed: {e}")
+
                     # 0) Se arriva SHOP=..., salva mapping persistente (per sempre)
                     hint = extract_shop_hint(text)
                     if hint:
@@ -1319,6 +2233,8 @@ def webhook():
 
     except Exception as e:
         _log(f"[WEBHOOK] processing error: {e}")
+    finally:
+        flush_sheets_writes()
 
     return "OK", 200
 
@@ -1336,7 +2252,11 @@ def test():
     if not shop:
         return jsonify({"error": "shop not found"}), 404
 
-    reply = handle(shop, customer, msg)
+    begin_sheets_write_buffer()
+    try:
+        reply = handle(shop, customer, msg)
+    finally:
+        flush_sheets_writes()
     return jsonify({
         "shop": shop.get("name"),
         "shop_number": phone,
@@ -1346,5 +2266,25 @@ def test():
     }), 200
 
 
+@app.route("/admin/invalidate_cache", methods=["POST"])
+def admin_invalidate_cache():
+    """
+    Svuota la cache dei tab config dopo una modifica al foglio (senza aspettare il TTL).
+    ?tab=shops per un solo tab. Header X-Admin-Token = ADMIN_TOKEN.
+    """
+    # bytes: compare_digest su str con caratteri non ASCII solleva TypeError (500)
+    token = request.headers.get("X-Admin-Token", "").encode("utf-8")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN.encode("utf-8")):
+        return "Forbidden", 403
+
+    tab = norm_text(request.args.get("tab")) or None
+    if tab and tab not in CONFIG_TABS:
+        return jsonify({"error": f"unknown tab: {tab}"}), 400
+
+    invalidate_tab_cache(tab)
+    _log(f"[CACHE] invalidated {tab or 'all tabs'}")
+    return jsonify({"invalidated": [tab] if tab else list(CONFIG_TABS)}), 200
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
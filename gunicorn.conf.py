@@ -0,0 +1,28 @@
+# Caricato automaticamente da gunicorn (vedi Procfile).
+import os
+
+
+def on_starting(server):
+    # sessioni "memory" e dedup message id sono per processo: con più worker i messaggi
+    # dello stesso cliente (e i retry di Meta) finiscono su processi diversi
+    if server.cfg.workers <= 1:
+        return
+    backend = os.getenv("SESSION_BACKEND", "").strip().lower() or ("redis" if os.getenv("REDIS_URL", "").strip() else "memory")
+    if backend == "memory":
+        server.log.warning(
+            "workers=%s con SESSION_BACKEND=memory: le sessioni si perdono tra un messaggio e l'altro. "
+            "Usa un solo worker (scala con GUNICORN_THREADS) oppure SESSION_BACKEND=redis|sqlite.",
+            server.cfg.workers,
+        )
+    server.log.warning(
+        "workers=%s: il dedup dei message id è per processo, un retry di Meta su un altro worker "
+        "può ricevere una seconda risposta.",
+        server.cfg.workers,
+    )
+
+
+def post_worker_init(worker):
+    # cache tab config calda prima del primo webhook (WARMUP=false per disattivare)
+    if os.getenv("WARMUP", "true").strip().lower() in {"1", "true", "yes", "y", "si", "sì"}:
+        from app import warmup
+        warmup()